@@ -14,6 +14,9 @@ import os
 import sys
 from pathlib import Path
 import sqlite3
+import threading
+import csv
+import numpy as np
 import pandas as pd
 import io
 import base64
@@ -39,76 +42,222 @@ DB_PATH = get_cwd_path(DB_FILE)
 LOGO_PATH = get_cwd_path(LOGO_FILE)
 
 # ---------- DB ----------
+@st.cache_resource(show_spinner=False)
+def get_db():
+    """
+    Conexão única com o SQLite, reaproveitada entre os reruns do Streamlit
+    (evita abrir/fechar o arquivo do banco a cada interação), e o lock que
+    serializa as escritas das várias sessões (threads) sobre ela. Leituras não
+    usam o lock: rodam na mesma conexão, então ele não daria isolamento.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # LIKE do SQLite só ignora maiúsculas em ASCII; casefold cobre acentos (É/é)
+    conn.create_function("casefold", 1, lambda s: s.casefold() if s is not None else None, deterministic=True)
+    return conn, threading.Lock()
+
+def get_conn() -> sqlite3.Connection:
+    return get_db()[0]
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            cost REAL NOT NULL,
-            price REAL NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def fetch_books_df() -> pd.DataFrame:
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("SELECT id, title, cost, price FROM books ORDER BY id ASC", conn)
-    conn.close()
-    return df
+    conn, lock = get_db()
+    with lock:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                cost REAL NOT NULL,
+                price REAL NOT NULL
+            )
+        """)
+        conn.commit()
+
+@st.cache_resource(show_spinner=False)
+def get_version_holder() -> dict:
+    """Contador de versão dos dados, único no processo (todas as sessões)."""
+    return {"version": 0}
+
+def books_version() -> int:
+    """Chave de cache das leituras: muda a cada escrita no banco."""
+    return get_version_holder()["version"]
+
+def bump_books_version():
+    """Invalida o cache de leitura após qualquer escrita no banco."""
+    _, lock = get_db()
+    with lock:
+        get_version_holder()["version"] += 1
+
+@st.cache_data(max_entries=4)
+def fetch_books_df(version: int) -> pd.DataFrame:
+    # `version` só serve como chave do cache (muda a cada escrita)
+    # lucro calculado uma vez aqui e reaproveitado por gráficos/tabela
+    return pd.read_sql_query("SELECT id, title, cost, price, (price - cost) AS profit FROM books ORDER BY id ASC", get_conn())
+
+def build_filter_sql(search: str, mode: str):
+    """
+    Monta o WHERE (busca por título + filtro de lucro) e seus parâmetros.
+    mode: "Todos", "Lucro positivo" ou "Lucro negativo/zero".
+    """
+    where, params = [], []
+    if search:
+        escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("casefold(title) LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped.casefold()}%")
+    if mode == "Lucro positivo":
+        where.append("(price - cost) > 0")
+    elif mode != "Todos":
+        where.append("(price - cost) <= 0")
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+# uma entrada por texto digitado na busca: limitado para não crescer sem fim
+@st.cache_data(max_entries=32)
+def fetch_filtered(version: int, search: str, mode: str) -> pd.DataFrame:
+    """Busca por título e filtro de lucro feitos direto no SQLite."""
+    where_sql, params = build_filter_sql(search, mode)
+    sql = f"SELECT id, title, cost, price, (price - cost) AS profit FROM books{where_sql} ORDER BY id ASC"
+    return pd.read_sql_query(sql, get_conn(), params=params)
+
+@st.cache_data(max_entries=32)
+def fetch_books_light(version: int, search: str, mode: str) -> list:
+    """
+    Só (id, title, price) dos livros filtrados, como tuplas simples.
+    Reaproveita o resultado de fetch_filtered (sem varrer a tabela de novo).
+    """
+    df = fetch_filtered(version, search, mode)
+    return list(df[['id', 'title', 'price']].itertuples(index=False, name=None))
+
+@st.cache_data(max_entries=4)
+def fetch_totals(version: int) -> tuple:
+    """(custo total, venda total, lucro total) numa única agregação."""
+    row = get_conn().execute(
+        "SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(price), 0), COALESCE(SUM(price - cost), 0) FROM books"
+    ).fetchone()
+    return tuple(float(v) for v in row)
+
+def get_book(book_id: int):
+    """(title, cost, price) de um livro, buscado pela chave primária."""
+    return get_conn().execute("SELECT title, cost, price FROM books WHERE id=?", (book_id,)).fetchone()
+
+def bulk_add_books(rows):
+    """
+    Insere vários livros (title, cost, price) numa única transação.
+    """
+    conn, lock = get_db()
+    with lock, conn:
+        conn.executemany("INSERT INTO books (title, cost, price) VALUES (?, ?, ?)", rows)
+    bump_books_version()
 
 def add_book_db(title: str, cost: float, price: float):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO books (title, cost, price) VALUES (?, ?, ?)", (title, cost, price))
-    conn.commit()
-    conn.close()
+    bulk_add_books([(title, cost, price)])
 
 def update_book_db(book_id: int, title: str, cost: float, price: float):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE books SET title=?, cost=?, price=? WHERE id=?", (title, cost, price, book_id))
-    conn.commit()
-    conn.close()
+    conn, lock = get_db()
+    with lock, conn:
+        conn.execute("UPDATE books SET title=?, cost=?, price=? WHERE id=?", (title, cost, price, book_id))
+    bump_books_version()
 
 def delete_book_db(book_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM books WHERE id=?", (book_id,))
-    conn.commit()
-    conn.close()
+    conn, lock = get_db()
+    with lock, conn:
+        conn.execute("DELETE FROM books WHERE id=?", (book_id,))
+    bump_books_version()
 
 # ---------- UI helpers ----------
+@st.cache_resource(max_entries=1)
+def read_logo_bytes(path_str: str, mtime: float):
+    # `mtime` só entra na chave do cache: trocar o logo.png invalida a leitura
+    try:
+        return Path(path_str).read_bytes()
+    except:
+        return None
+
 def load_logo_bytes(path: Path):
-    if path.exists():
-        try:
-            return path.read_bytes()
-        except:
-            return None
-    return None
-
-def df_with_index_for_display(df: pd.DataFrame) -> pd.DataFrame:
-    df2 = df.copy()
-    df2['Lucro (R$)'] = df2['price'] - df2['cost']
-    df2['Índice'] = range(1, len(df2) + 1)
-    if 'id' in df2.columns:
-        df2 = df2[['Índice', 'id', 'title', 'cost', 'price', 'Lucro (R$)']]
-        df2.columns = ['Índice', 'ID', 'Título', 'Custo (R$)', 'Venda (R$)', 'Lucro (R$)']
+    # só um stat por rerun; a leitura do arquivo fica em cache
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None
+    return read_logo_bytes(str(path), mtime)
+
+def df_with_index_for_display(df_orig: pd.DataFrame) -> pd.DataFrame:
+    if 'id' not in df_orig.columns:
+        return pd.DataFrame(columns=['Índice', 'ID', 'Título', 'Custo (R$)', 'Venda (R$)', 'Lucro (R$)'])
+    # lucro já vem calculado pelo SQL (coluna profit)
+    df2 = df_orig.assign(**{'Lucro (R$)': df_orig['profit'], 'Índice': np.arange(1, len(df_orig) + 1, dtype=np.int32)})
+    cols = pd.Index(['Índice', 'id', 'title', 'cost', 'price', 'Lucro (R$)'])
+    df2 = df2.reindex(columns=cols.intersection(df2.columns, sort=False))
+    return df2.rename(columns={'id': 'ID', 'title': 'Título', 'cost': 'Custo (R$)', 'price': 'Venda (R$)'})
+
+# figuras em cache_resource: devolve o mesmo objeto, sem o custo de
+# unpickle que o cache_data teria a cada acerto
+@st.cache_resource(max_entries=4)
+def build_bar(totals: tuple):
+    """Gráfico de barras dos totais; a tupla (custo, venda, lucro) é a chave do cache."""
+    total_cost, total_price, total_profit = totals
+    bars = {
+        "Custo": total_cost,
+        "Venda": total_price,
+        "Lucro": total_profit
+    }
+    bar_fig = go.Figure(data=[go.Bar(
+        x=list(bars.keys()),
+        y=list(bars.values()),
+        marker=dict(color=["#FB7185", "#60A5FA", "#34D399"]),
+        text=[f"R$ {v:,.2f}" for v in bars.values()],
+        textposition='outside'
+    )])
+    bar_fig.update_layout(title="Totais: Custo / Venda / Lucro", yaxis_title="R$",
+                          margin=dict(t=40,l=20,r=20,b=20), height=420)
+    return bar_fig
+
+@st.cache_resource(max_entries=4)
+def build_pie(version: int):
+    """Pizza de lucro por livro (top 8 + Outros); refeita só quando os dados mudam."""
+    df = fetch_books_df(version)
+    if not df.empty:
+        abs_profit = df['profit'].abs()
+        top = abs_profit.nlargest(8)
+        labels = df.loc[top.index, 'title'].tolist()
+        vals = top.tolist()
+        if len(abs_profit) > 8:
+            labels.append('Outros')
+            vals.append(abs_profit.drop(top.index).sum())
+        pie_fig = px.pie(values=vals, names=labels, title="Distribuição de lucro por livro")
+        pie_fig.update_traces(textposition='inside', textinfo='percent+label')
+        pie_fig.update_layout(margin=dict(t=30,l=10,r=10,b=10), height=420)
     else:
-        df2 = pd.DataFrame(columns=['Índice', 'ID', 'Título', 'Custo (R$)', 'Venda (R$)', 'Lucro (R$)'])
-    return df2
-
-def to_csv_bytes(df: pd.DataFrame) -> bytes:
-    return df.to_csv(index=False, float_format="%.2f", encoding='utf-8-sig').encode('utf-8-sig')
+        pie_fig = go.Figure()
+        pie_fig.update_layout(title="Nenhum dado para distribuição", height=420)
+    return pie_fig
 
-# ---------- Inicialização ----------
-init_db()
+def iter_csv(chunk_size: int = 1000):
+    """
+    Gera o CSV de exportação em blocos, lendo direto do cursor do SQLite
+    (sem montar DataFrame nem a string inteira antes de codificar).
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['id', 'title', 'cost', 'price', 'lucro'])
+    yield ('\ufeff' + buf.getvalue()).encode('utf-8')  # BOM para o Excel
+    # arredondado no SQL: as linhas vão direto para o writer, sem formatar célula a célula
+    cur = get_conn().execute(
+        "SELECT id, title, ROUND(cost, 2), ROUND(price, 2), ROUND(price - cost, 2) FROM books ORDER BY id ASC"
+    )
+    while rows := cur.fetchmany(chunk_size):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(rows)
+        yield buf.getvalue().encode('utf-8')
 
 # ---------- Streamlit App ----------
+# set_page_config precisa ser o primeiro comando Streamlit (antes de qualquer cache)
 st.set_page_config(page_title=APP_TITLE, layout="wide", initial_sidebar_state="expanded")
 
+# ---------- Inicialização ----------
+init_db()
+
 # custom CSS for nicer look
 st.markdown("""
 <style>
@@ -155,41 +304,25 @@ search = st.sidebar.text_input("Pesquisar por título")
 filter_profit = st.sidebar.selectbox("Mostrar", ["Todos", "Lucro positivo", "Lucro negativo/zero"])
 st.sidebar.markdown("### Exportar")
 if st.sidebar.button("Exportar CSV (todos)"):
-    df_export = fetch_books_df()
-    if df_export.empty:
+    has_books = get_conn().execute("SELECT EXISTS(SELECT 1 FROM books)").fetchone()[0]
+    if not has_books:
         st.sidebar.warning("Sem dados para exportar.")
     else:
         st.sidebar.success("Preparando download...")
-        b = to_csv_bytes(df_export)
+        # download_button precisa do conteúdo pronto; juntamos os blocos uma única vez
+        b = b"".join(iter_csv())
         st.sidebar.download_button("Baixar CSV", data=b, file_name="books_export.csv", mime="text/csv")
 
 # main content: top = table, bottom = charts
-df = fetch_books_df()
-df_display = df_with_index_for_display(df)
-
-# Apply search and filter (for display only)
-def apply_filters(df_orig: pd.DataFrame) -> pd.DataFrame:
-    df2 = df_orig.copy()
-    if search:
-        df2 = df2[df2['title'].str.contains(search, case=False, na=False)]
-    if filter_profit != "Todos":
-        df2['profit'] = df2['price'] - df2['cost']
-        if filter_profit == "Lucro positivo":
-            df2 = df2[df2['profit'] > 0]
-        else:
-            df2 = df2[df2['profit'] <= 0]
-    return df2
-
-df_filtered = apply_filters(df)
+# Apply search and filter (for display only) — feito no SQL
+df_filtered = fetch_filtered(books_version(), search, filter_profit)
 
 # Show table (with index visual). We'll use the display DF built from df_filtered
 df_filtered_display = df_with_index_for_display(df_filtered)
 st.markdown("### 📚 Lista de livros")
 st.markdown('<div class="card">', unsafe_allow_html=True)
 # show totals at top (summary)
-total_cost = df['cost'].sum() if not df.empty else 0.0
-total_price = df['price'].sum() if not df.empty else 0.0
-total_profit = (df['price'] - df['cost']).sum() if not df.empty else 0.0
+total_cost, total_price, total_profit = fetch_totals(books_version())
 
 tcol1, tcol2, tcol3 = st.columns([1,1,1])
 tcol1.metric("Custo total", f"R$ {total_cost:,.2f}")
@@ -202,19 +335,17 @@ st.markdown("</div>", unsafe_allow_html=True)
 
 # Select a row for edit/delete using Índice mapping
 st.markdown("### Ações rápidas")
-if df_filtered.empty:
+rows = fetch_books_light(books_version(), search, filter_profit)
+if not rows:
     st.info("Sem livros cadastrados (ou filtro resultou em vazio).")
 else:
-    # map index display -> book id
-    mapping = df_filtered.reset_index(drop=True)[['title','cost','price','id']].copy()
-    mapping['Índice_exib'] = range(1, len(mapping) + 1)
-    # choice list
-    choice_strs = mapping.apply(lambda r: f"{int(r['Índice_exib'])} — {r['title']} (Venda: R$ {r['price']:.2f})", axis=1).tolist()
+    # choice list (índice exibido -> book id via rows[idx])
+    choice_strs = [f"{i} — {t} (Venda: R$ {p:.2f})" for i, (_, t, p) in enumerate(rows, 1)]
     selected_choice = st.selectbox("Selecione um livro (para editar ou excluir)", ["— nenhum —"] + choice_strs)
     selected_book_id = None
     if selected_choice != "— nenhum —":
         idx = choice_strs.index(selected_choice)
-        selected_book_id = int(mapping.loc[idx, 'id'])
+        selected_book_id = rows[idx][0]
 
 # Form area (Adicionar / Editar)
 st.markdown("### Formulário")
@@ -234,14 +365,18 @@ with st.form("book_form", clear_on_submit=False):
                 st.experimental_rerun()
     else:
         st.subheader("Editar livro existente")
+        book = get_book(selected_book_id) if selected_book_id is not None else None
         if selected_book_id is None:
             st.warning("Selecione um livro acima para editar.")
+        elif book is None:
+            # excluído por outra sessão depois que a lista foi montada
+            st.warning("O livro selecionado não existe mais. Selecione outro.")
         else:
             # load current values
-            sel_row = df[df['id'] == selected_book_id].iloc[0]
-            title_e = st.text_input("Título", value=sel_row['title'])
-            cost_e = st.number_input("Custo (R$)", min_value=0.0, value=float(sel_row['cost']), format="%.2f", key="cost_e")
-            price_e = st.number_input("Venda (R$)", min_value=0.0, value=float(sel_row['price']), format="%.2f", key="price_e")
+            title_v, cost_v, price_v = book
+            title_e = st.text_input("Título", value=title_v)
+            cost_e = st.number_input("Custo (R$)", min_value=0.0, value=float(cost_v), format="%.2f", key="cost_e")
+            price_e = st.number_input("Venda (R$)", min_value=0.0, value=float(price_v), format="%.2f", key="price_e")
             submitted_edit = st.form_submit_button("Salvar alterações")
             if submitted_edit:
                 if not title_e.strip():
@@ -274,40 +409,8 @@ if selected_book_id is not None:
 st.markdown("### 📊 Análise visual")
 st.markdown('<div class="card">', unsafe_allow_html=True)
 
-# Large bar chart for totals
-totals = {
-    "Custo": total_cost,
-    "Venda": total_price,
-    "Lucro": total_profit
-}
-bar_fig = go.Figure(data=[go.Bar(
-    x=list(totals.keys()),
-    y=list(totals.values()),
-    marker=dict(color=["#FB7185", "#60A5FA", "#34D399"]),
-    text=[f"R$ {v:,.2f}" for v in totals.values()],
-    textposition='outside'
-)])
-bar_fig.update_layout(title="Totais: Custo / Venda / Lucro", yaxis_title="R$",
-                      margin=dict(t=40,l=20,r=20,b=20), height=420)
-
-# Pie chart: distribuição de lucro por livro (top)
-if not df.empty:
-    df['profit'] = df['price'] - df['cost']
-    prof = df.set_index('title')['profit'].abs().sort_values(ascending=False)
-    if len(prof) > 8:
-        top = prof.iloc[:8]
-        others = prof.iloc[8:].sum()
-        labels = list(top.index) + ['Outros']
-        vals = list(top.values) + [others]
-    else:
-        labels = list(prof.index)
-        vals = list(prof.values)
-    pie_fig = px.pie(values=vals, names=labels, title="Distribuição de lucro por livro")
-    pie_fig.update_traces(textposition='inside', textinfo='percent+label')
-    pie_fig.update_layout(margin=dict(t=30,l=10,r=10,b=10), height=420)
-else:
-    pie_fig = go.Figure()
-    pie_fig.update_layout(title="Nenhum dado para distribuição", height=420)
+bar_fig = build_bar((total_cost, total_price, total_profit))
+pie_fig = build_pie(books_version())
 
 c1, c2 = st.columns([2,1])
 with c1: